@@ -1,12 +1,68 @@
+import asyncio
+import threading
 import time
 from abc import abstractmethod
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import chain, islice
 from os import getenv
-from typing import List, TypedDict, Union, Dict
+from typing import List, TypedDict, Union, Dict, Set, Iterable, Iterator, Awaitable
 
-from pymongo import MongoClient, UpdateOne
+from pymongo import MongoClient, IndexModel, InsertOne, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError
 from selfcord import Object as DiscordObject, Message, Thread, MessageType
 
 
+@lru_cache(maxsize=None, typed=True)
+def _enum_str(value) -> str:
+    """
+    str() of a discord enum member, computed once per member.
+    typed, since members are (name, value) namedtuples and e.g. ChannelType.unknown_50 == MessageType.unknown_50.
+    """
+    return str(value)
+
+
+def _chunks(items: Iterable, n: int) -> Iterator[list]:
+    """ Yield successive lists of up to n items. """
+    it = iter(items)
+    while batch := list(islice(it, n)):
+        yield batch
+
+
+class _LRUSet:
+    """ Set holding at most maxsize items, evicting the least recently used. Safe to share between threads. """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, item) -> bool:
+        with self._lock:
+            if item not in self._items:
+                return False
+            self._items.move_to_end(item)
+            return True
+
+    def add(self, item):
+        self.update((item,))
+
+    def update(self, items: Iterable):
+        with self._lock:
+            for item in items:
+                self._items[item] = None
+                self._items.move_to_end(item)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+
+_DUPLICATE_KEY_ERROR = 11000
+_THREAD_CREATED = MessageType.thread_created
+
+# bounds the number of thread histories being fetched at once
+_thread_fetch_semaphore = asyncio.Semaphore(25)
+
+
 class Frontier(TypedDict):
     id: Union[int, None]
     previous_scan_time: int
@@ -21,21 +77,30 @@ class MessageConverter:
         :return: Converted message
         """
 
+    async def convert_thread_messages(self, thread: Thread) -> List[dict]:
+        """
+        Fetch the history of the given thread and convert its messages concurrently.
+        """
+        async with _thread_fetch_semaphore:
+            thread_messages = [x async for x in thread.history()]
+        return list(await asyncio.gather(*(self.convert_message(x) for x in thread_messages)))
+
 
 class SimpleMessageConverter(MessageConverter):
     def __init__(self):
         self.authors = set()
 
     async def convert_message(self, message: Message, thread: Thread = None) -> dict:
+        attachments, embeds = message.attachments, message.embeds
         message_obj = {
             "channel_id": message.channel.id,
-            "channel_type": str(message.channel.type),
+            "channel_type": _enum_str(message.channel.type),
             "message_id": message.id,
             "message_content": message.content,
             "timestamp": message.created_at,
             "edited_timestamp": message.edited_at,
-            "attachments": [x.to_dict() for x in message.attachments],
-            "embeds": [x.to_dict() for x in message.embeds],
+            "attachments": [x.to_dict() for x in attachments] if attachments else [],
+            "embeds": [x.to_dict() for x in embeds] if embeds else [],
             "author_id": message.author.id,
             "reply_to": None,
             "thread": None,
@@ -51,7 +116,7 @@ class SimpleMessageConverter(MessageConverter):
                 "created_timestamp": thread.created_at,
                 "message_count": thread.message_count,
                 "owner_id": thread.owner_id,
-                "messages": [(await self.convert_message(x)) async for x in thread.history()]
+                "messages": await self.convert_thread_messages(thread)
             }
         self.authors.add(message_obj["author_id"])
         return message_obj
@@ -62,15 +127,16 @@ class MongoMessageConverter(MessageConverter):
         self.authors = set()
 
     async def convert_message(self, message: Message, thread: Thread = None):
+        attachments, embeds = message.attachments, message.embeds
         message_obj = {
             "channel_id": message.channel.id,
-            "channel_type": str(message.channel.type),
+            "channel_type": _enum_str(message.channel.type),
             "message_id": message.id,
-            "message_type": str(message.type),
+            "message_type": _enum_str(message.type),
             "timestamp": message.created_at,
             "edited_timestamp": message.edited_at,
-            "attachments": [x.to_dict() for x in message.attachments],
-            "embeds": [x.to_dict() for x in message.embeds],
+            "attachments": [x.to_dict() for x in attachments] if attachments else [],
+            "embeds": [x.to_dict() for x in embeds] if embeds else [],
             "author_id": message.author.id,
             "reply_to": None,
             "thread": None,
@@ -89,7 +155,7 @@ class MongoMessageConverter(MessageConverter):
                 "created_timestamp": thread.created_at,
                 "message_count": thread.message_count,
                 "owner_id": thread.owner_id,
-                "messages": [(await self.convert_message(x)) async for x in thread.history()]
+                "messages": await self.convert_thread_messages(thread)
             }
 
         self.authors.add(message_obj["author_id"])
@@ -136,6 +202,13 @@ class DataStore:
         Save multiple messages to the store
         """
 
+    @abstractmethod
+    def insert_messages(self, messages: List):
+        """
+        Save multiple messages which are expected to be new to the store.
+        Messages which turn out to already be present are saved as with save_messages.
+        """
+
     @abstractmethod
     def set_frontier(self, channel_id: int, data: Frontier):
         """
@@ -148,20 +221,35 @@ class DataStore:
         :return: Whether a message with message_id is present in the store
         """
 
+    @abstractmethod
+    def messages_exist(self, message_ids: List[int]) -> Set[int]:
+        """
+        :return: The subset of message_ids which are present in the store
+        """
+
 
 class MongoStore(DataStore):
+    _indexes_created = False  # index creation only needs to happen once per process
+
     def __init__(self):
         self.client = MongoClient(getenv("MONGO_HOST", "localhost"), int(getenv("MONGO_PORT", 27017)))
         self.db = self.client["discord_db"]
-        self.messages = self.db["messages"]
+        # upserts are idempotent, so journal acknowledgement isn't needed
+        self.messages = self.db.get_collection("messages", write_concern=WriteConcern(w=1, j=False))
         self.frontiers = self.db["frontiers"]
         self.channels = self.db["channels"]  # these three could just be a single collection i think. the point is to give me a mapping from channels to guilds so that i can build a URL, from authors to author data so that i can display it nicely, and same for guilds.
         self.authors = self.db["authors"]
         self.guilds = self.db["guilds"]
+        # recently stored message IDs, to skip existence queries
+        self._seen = _LRUSet(int(getenv("MONGO_SEEN_CACHE_SIZE", 100000)))
+        self.bulk_chunk_size = int(getenv("MONGO_BULK_CHUNK_SIZE", 1000))
+        # one document per target channel, so it is kept in memory and only written through
+        self._frontiers_cache = {x["channel_id"]: x for x in self.frontiers.find()}
 
         # create indices
-        self.messages.create_index("message_id", unique=True)
-        self.messages.create_index("timestamp")
+        if not MongoStore._indexes_created:
+            self.messages.create_indexes([IndexModel("message_id", unique=True), IndexModel("timestamp")])
+            MongoStore._indexes_created = True
 
     def save_message(self, mongo_updater: dict):
         self.save_messages([mongo_updater])
@@ -170,28 +258,77 @@ class MongoStore(DataStore):
         pass
 
     def save_messages(self, mongo_updater: List[dict]):
-        self.messages.bulk_write([
-            UpdateOne({"message_id": message["$set"]["message_id"]}, message, upsert=True) for message in mongo_updater
-        ])
-        replies = [
+        # every message upsert is sent before any reply update: a reply's $addToSet creates a stub for a parent
+        # that is not stored yet, and the parent's own upsert would then skip its $setOnInsert fields.
+        # ordered=False only means later ops still run after a failure; the server applies a batch's ops in the
+        # order given, so placing the reply updates after the message upserts in the same bulk_write is enough.
+        ops = chain(
+            (UpdateOne({"message_id": message["$set"]["message_id"]}, message, upsert=True) for message in mongo_updater),
+            self._reply_updates(mongo_updater)
+        )
+        for batch in _chunks(ops, self.bulk_chunk_size):
+            self.messages.bulk_write(batch, ordered=False)
+        self._seen.update(message["$set"]["message_id"] for message in mongo_updater)
+
+    def insert_messages(self, mongo_updater: List[dict]):
+        # pairs of (message, op), with message None for reply updates, which go last as in save_messages
+        ops = chain(
+            ((message, InsertOne({**message["$set"], **message["$setOnInsert"]})) for message in mongo_updater),
+            ((None, op) for op in self._reply_updates(mongo_updater))
+        )
+        for batch in _chunks(ops, self.bulk_chunk_size):
+            try:
+                self.messages.bulk_write([op for _, op in batch], ordered=False)
+            except BulkWriteError as e:
+                errors = e.details.get("writeErrors", [])
+                if not errors or e.details.get("writeConcernErrors") or \
+                        any(error["code"] != _DUPLICATE_KEY_ERROR or batch[error["index"]][0] is None for error in errors):
+                    raise
+                # already stored, either by the live listener or as a stub created by a reply's $addToSet.
+                # a stub matches the upsert, so the $setOnInsert fields are filled in separately where missing.
+                duplicates = [batch[error["index"]][0] for error in errors]
+                self.messages.bulk_write([
+                    UpdateOne({"message_id": message["$set"]["message_id"]}, message, upsert=True) for message in duplicates
+                ] + [
+                    UpdateOne({"message_id": message["$set"]["message_id"], "message_content": {"$exists": False}}, {"$set": message["$setOnInsert"]}) for message in duplicates
+                ], ordered=False)
+        self._seen.update(message["$set"]["message_id"] for message in mongo_updater)
+
+    @staticmethod
+    def _reply_updates(mongo_updater: List[dict]) -> Iterator[UpdateOne]:
+        return (
             UpdateOne({"message_id": message["$set"]["reply_to"]["message_id"]}, {"$addToSet": {"replies": message["$set"]["message_id"]}}, upsert=True) for message in mongo_updater if message["$set"]["reply_to"]
-        ]
-        if replies:
-            self.messages.bulk_write(replies)
+        )
 
     def message_exists(self, message_id: int):
-        return self.messages.find_one({"message_id": message_id}) is not None
+        if message_id in self._seen:
+            return True
+        found = self.messages.find_one({"message_id": message_id}, {"message_id": 1, "_id": 0}) is not None
+        if found:
+            self._seen.add(message_id)
+        return found
+
+    def messages_exist(self, message_ids: List[int]):
+        found = {x for x in message_ids if x in self._seen}
+        unknown = [x for x in message_ids if x not in found]
+        if unknown:
+            stored = {doc["message_id"] for doc in self.messages.find({"message_id": {"$in": unknown}}, {"message_id": 1, "_id": 0})}
+            self._seen.update(stored)
+            found |= stored
+        return found
 
     def get_frontier(self, channel_id: int):
-        return self.frontiers.find_one({"channel_id": channel_id}) or {}
+        return dict(self._frontiers_cache.get(channel_id, {}))
 
     def get_frontiers(self):
-        return {x["channel_id"]: x for x in self.frontiers.find()}
+        return dict(self._frontiers_cache)
 
     def update_frontier(self, channel_id: int, new_message_id: int):
+        self._frontiers_cache[channel_id] = {**self._frontiers_cache.get(channel_id, {"channel_id": channel_id}), "id": new_message_id}
         self.frontiers.update_one({"channel_id": channel_id}, {"$set": {"id": new_message_id}}, upsert=True)
 
     def set_frontier(self, channel_id: int, data: Frontier):
+        self._frontiers_cache[channel_id] = {**self._frontiers_cache.get(channel_id, {"channel_id": channel_id}), **data}
         self.frontiers.update_one({"channel_id": channel_id}, {"$set": data}, upsert=True)
 
 
@@ -199,12 +336,18 @@ class BasicStore(DataStore):
     def __init__(self):
         self.messages = []
         self.frontier = {}
+        self._ids = set()
 
     def save_message(self, message: dict):
         self.messages.append(message)
+        self._ids.add(message["message_id"])
 
     def save_messages(self, messages: List):
         self.messages.extend(messages)
+        self._ids.update(message["message_id"] for message in messages)
+
+    def insert_messages(self, messages: List):
+        self.save_messages(messages)
 
     def get_frontiers(self):
         return self.frontier
@@ -219,20 +362,23 @@ class BasicStore(DataStore):
         self.frontier[channel_id] = {**self.get_frontier(channel_id), "id": new_message_id}
 
     def message_exists(self, message_id: int):
-        return any(message_data["message_id"] == message_id for message_data in self.messages)
+        return message_id in self._ids
+
+    def messages_exist(self, message_ids: List[int]):
+        return self._ids.intersection(message_ids)
 
 
 class DataManager:
     def __init__(self, target_channels: List[int],
-                 store: DataStore = MongoStore(), converter: MessageConverter = MongoMessageConverter()):
+                 store: DataStore = None, converter: MessageConverter = None):
         """
         :param target_channels: List of channels to be scraped
-        :param store:
-        :param converter:
+        :param store: Defaults to a MongoStore
+        :param converter: Defaults to a MongoMessageConverter
         """
         self.channels = target_channels
-        self.store = store
-        self.converter = converter
+        self.store = store or MongoStore()
+        self.converter = converter or MongoMessageConverter()
 
         self.rescan_interval = {channel: 60 for channel in self.channels}
 
@@ -243,7 +389,14 @@ class DataManager:
         """
         :return: List of the channels that are currently set for scraping.
         """
-        return [x for x in self.channels if self.get_frontier_message(x) or self.should_rescan(x)]
+        frontiers = self.store.get_frontiers()
+        return [x for x in self.channels if frontiers.get(x, {}).get("id") or self._rescan_due(frontiers.get(x, {}), x)]
+
+    def is_first_scan(self, channel_id: int):
+        """
+        :return: Whether the given channel has never been fully scraped
+        """
+        return not self.get_frontier(channel_id).get("previous_scan_time")
 
     def get_frontier_message(self, channel_id: int):
         """
@@ -261,30 +414,43 @@ class DataManager:
         """
         Determines whether a rescrape is due for the given channel
         """
-        timestamp = self.get_frontier(channel_id).get("previous_scan_time", 0)
+        return self._rescan_due(self.get_frontier(channel_id), channel_id)
+
+    def _rescan_due(self, frontier: Frontier, channel_id: int):
+        timestamp = frontier.get("previous_scan_time", 0)
         return timestamp < time.time() - self.rescan_interval[channel_id]
 
     async def save_message(self, message: Message, update_frontier=False):
         """
         Saves the given message in the database, and updates the frontier if necessary.
         """
-        if message.type != MessageType.thread_created:
+        if message.type is not _THREAD_CREATED:
             converted_message = await self.convert_message(message)
-            self.store.save_message(converted_message)
+            await asyncio.to_thread(self.store.save_message, converted_message)
 
         if update_frontier:
-            self.store.update_frontier(message.channel.id, message.id)
+            await asyncio.to_thread(self.store.update_frontier, message.channel.id, message.id)
 
-    async def save_messages(self, messages: List[Message], update_frontier=False):
+    async def save_messages(self, messages: List[Message], update_frontier=False, new_messages=False,
+                            after: Awaitable = None):
         """
         Saves the given message in the database, and updates the frontier if necessary.
-        """
-        converted_messages = [await self.convert_message(message) for message in messages if message.type != MessageType.thread_created]
-        self.store.save_messages(converted_messages)
+        :param new_messages: Whether the messages are expected to not be stored yet, allowing plain inserts.
+        :param after: Optional awaitable, such as the save of the preceding batch, which must complete before
+            the messages are written. Conversion is not held back by it.
+        """
+        if not messages:
+            return
+        relevant = [message for message in messages if message.type is not _THREAD_CREATED]
+        converted_messages = await asyncio.gather(*(self.convert_message(message) for message in relevant))
+        if after is not None:
+            await after
+        save = self.store.insert_messages if new_messages else self.store.save_messages
+        await asyncio.to_thread(save, converted_messages)
 
         last_message = messages[-1]
         if update_frontier:
-            self.store.update_frontier(last_message.channel.id, last_message.id)
+            await asyncio.to_thread(self.store.update_frontier, last_message.channel.id, last_message.id)
 
     async def convert_message(self, message: Message):
         """
@@ -293,14 +459,20 @@ class DataManager:
         thread = message.channel.get_thread(message.id) if message.flags.has_thread else None
         return await self.converter.convert_message(message, thread)
 
-    def finish_frontier(self, channel_id: int):
+    async def finish_frontier(self, channel_id: int):
         """
         Marks the given channel scraping as complete and timestamps it.
         """
-        front = self.get_frontier(channel_id)
+        front = await asyncio.to_thread(self.get_frontier, channel_id)
         front["id"] = None
         front["previous_scan_time"] = int(time.time())
-        self.store.set_frontier(channel_id, front)
+        await asyncio.to_thread(self.store.set_frontier, channel_id, front)
 
-    def message_exists(self, message_id: int):
-        return self.store.message_exists(message_id)
+    async def message_exists(self, message_id: int):
+        return await asyncio.to_thread(self.store.message_exists, message_id)
+
+    async def messages_exist(self, message_ids: List[int]):
+        """
+        :return: Set of the given message IDs that are already stored
+        """
+        return await asyncio.to_thread(self.store.messages_exist, message_ids)
@@ -1,9 +1,9 @@
 import logging
 import os
 import time
-from asyncio import sleep
+from asyncio import sleep, gather, Semaphore, create_task
 from sys import stdout
-from typing import List
+from typing import List, Awaitable
 
 import selfcord
 from selfcord import Message
@@ -56,12 +56,15 @@ def delay_to_next_month():
 
 class Scraper:
     def __init__(self, client: selfcord.Client, data_manager: DataManager,
-                 sleep_delay=delay_to_next_month, message_fetch_limit=50):
+                 sleep_delay=delay_to_next_month, message_fetch_limit=50, exists_batch_size=100,
+                 max_concurrent_channels=8, save_batch_size=50):
         self.client = client
         self.data_manager = data_manager
-        self.channel_server_id = {channel_id: self.client.get_channel(channel_id).guild.id for channel_id in self.data_manager}
 
         self.limit = message_fetch_limit
+        self.exists_batch_size = exists_batch_size
+        self.save_batch_size = save_batch_size
+        self.channel_semaphore = Semaphore(max_concurrent_channels)
         self.sleep_time = sleep_delay
 
     async def begin_scraping(self):
@@ -91,14 +94,16 @@ class Scraper:
         Saves all messages to the message store.
         """
         current_channels = self.data_manager.get_targets()
-        i = 0
-        while current_channels:
-            i %= len(current_channels)
-            channel_empty = await self._scrape_channel(current_channels[i])
-            if channel_empty:
-                self.data_manager.finish_frontier(current_channels[i])
-                current_channels.pop(i)
-            i += 1
+        await gather(*(self._drain_channel(channel_id) for channel_id in current_channels))
+
+    async def _drain_channel(self, channel_id: int):
+        """
+        Scrape the given channel until its frontier is exhausted, then mark it as complete.
+        """
+        async with self.channel_semaphore:
+            while not await self._scrape_channel(channel_id):
+                pass
+            await self.data_manager.finish_frontier(channel_id)
 
     async def scrape_all_unseen(self):
         """
@@ -116,28 +121,72 @@ class Scraper:
     async def _scrape_channel(self, channel_id: int):
         channel = client.get_channel(channel_id)
         frontier = self.data_manager.get_frontier_message(channel_id)
+        # until a channel has been fully scraped once, its history is not in the store yet
+        new_messages = self.data_manager.is_first_scan(channel_id)
         logging.info(f"scraping channel: `{channel.name}` in server `{channel.guild.name}`")
-        messages = [message async for message in channel.history(limit=self.limit, after=frontier, oldest_first=True)]
-        await self._process_messages(messages)
-
-        scraping_complete = len(messages) == 0 or len(messages) != self.limit
+        message_count = 0
+        pending_batch = []
+        tasks = []
+        try:
+            async for message in channel.history(limit=self.limit, after=frontier, oldest_first=True):
+                if len(pending_batch) >= self.save_batch_size:
+                    # batches convert concurrently, but each is written only after the one before it,
+                    # so a reply never reaches the store ahead of the message it replies to
+                    tasks.append(create_task(self._process_messages(
+                        pending_batch, new_messages=new_messages, after=tasks[-1] if tasks else None)))
+                    pending_batch = []
+                pending_batch.append(message)
+                message_count += 1
+
+            # the frontier only moves once every earlier batch of the page is stored
+            if pending_batch:
+                await self._process_messages(pending_batch, update_frontier=True, new_messages=new_messages,
+                                             after=tasks[-1] if tasks else None)
+            await gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        scraping_complete = message_count == 0 or message_count != self.limit
         return scraping_complete
 
     async def _scrape_unseen_only(self, channel_id: int):
         channel = client.get_channel(channel_id)
         messages = []
+        block = []
         async for message in channel.history(limit=self.limit, oldest_first=None):
-            if self.data_manager.message_exists(message.id):
-                return
+            block.append(message)
+            if len(block) >= self.exists_batch_size:
+                if await self._extend_unseen(messages, block):
+                    break
+                block = []
+        else:
+            await self._extend_unseen(messages, block)
+
+        if messages:
+            await self._process_messages(messages)
+
+    async def _extend_unseen(self, messages: List[Message], block: List[Message]):
+        """
+        Append the messages in block to messages, up to the first one already present in the store.
+        :return: Whether a previously seen message was encountered
+        """
+        if not block:
+            return False
+        seen = await self.data_manager.messages_exist([message.id for message in block])
+        for message in block:
+            if message.id in seen:
+                return True
             messages.append(message)
-        await self._process_messages(messages)
+        return False
 
     async def _process_message(self, message: Message, update_frontier: bool = False):
         await self.data_manager.save_message(message, update_frontier)
         logging.debug(message.content)
 
-    async def _process_messages(self, messages: List[Message], update_frontier: bool = False):
-        await self.data_manager.save_messages(messages, update_frontier)
+    async def _process_messages(self, messages: List[Message], update_frontier: bool = False, new_messages: bool = False,
+                                after: Awaitable = None):
+        await self.data_manager.save_messages(messages, update_frontier, new_messages, after)
         logging.info(f"processed {len(messages)} messages")
         logging.log(logging.INFO - 1, str([
             message.content for message in messages